@@ -1,37 +1,110 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, Body, HTTPException, Depends, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from slowapi import Limiter
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime, timedelta
+from typing import Annotated, List, Optional
+from datetime import datetime
 import jwt
+import orjson
+import base64
+import hashlib
+import hmac
+import re
+import time
+from cachetools import TTLCache
 from passlib.context import CryptContext
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 import csv
 import io
-from fastapi.responses import StreamingResponse
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=200,
+    minPoolSize=20,
+    serverSelectionTimeoutMS=2000,
+    waitQueueTimeoutMS=1000,
+    # Negotiated with the server; zlib is the stdlib fallback
+    compressors="zstd,zlib",
+)
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# New hashes use argon2id; existing bcrypt hashes still verify
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__memory_cost=19456,
+    argon2__time_cost=2,
+    argon2__parallelism=1,
+)
 SECRET_KEY = "nursery_secret_key_change_in_production"
 ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_SECONDS = 30 * 86400
 security = HTTPBearer()
 
+# Password hashing is CPU-bound, so keep it off the event loop
+_pw_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Per-IP limit on the password-hashing endpoints. Behind an ingress the socket peer is the
+# proxy, so set FORWARDED_ALLOW_IPS (comma-separated, or '*') to the proxy addresses whose
+# X-Forwarded-For should be trusted. Unlike uvicorn's --forwarded-allow-ips, '*' takes the
+# nearest (rightmost) hop rather than the leftmost one, which the client controls.
+# uvicorn's proxy-header handling (trusting 127.0.0.1 by default) runs before this and may
+# already have rewritten request.client, so this is a second pass over the header: keep the
+# two trust lists consistent, or start uvicorn with --no-proxy-headers and configure it here only.
+FORWARDED_ALLOW_IPS = {ip.strip() for ip in os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1').split(',') if ip.strip()}
+
+def client_ip(request: Request) -> str:
+    host = get_remote_address(request)
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    if "*" in FORWARDED_ALLOW_IPS:
+        return hops[-1] if hops else host
+    if host not in FORWARDED_ALLOW_IPS:
+        return host
+    # Walk back from the nearest hop; the first address not belonging to a trusted proxy is the client
+    for hop in reversed(hops):
+        if hop not in FORWARDED_ALLOW_IPS:
+            return hop
+    return hops[0] if hops else host
+
+limiter = Limiter(key_func=client_ip)
+
+def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    # Same {"detail": ...} shape as every other API error
+    return ORJSONResponse({"detail": "Too many attempts, please try again later"}, status_code=429)
+
+# HS256 verification state: every token we mint carries this exact header segment
+_JWT_HEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+_B64URL_SEGMENT = re.compile(rb"[A-Za-z0-9_-]*")
+_jwt_hmac = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+
+# Verified tokens, keyed by a digest of the raw token -> (username, exp)
+_jwt_cache = TTLCache(maxsize=10000, ttl=30)
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 api_router = APIRouter(prefix="/api")
 
 # Models
@@ -108,212 +181,312 @@ class DashboardStats(BaseModel):
     total_in_nursery: int
 
 # Helper functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pw_executor, pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pw_executor, pwd_context.hash, password)
 
 def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=30)
-    to_encode.update({"exp": expire})
+    to_encode = {**data, "exp": int(time.time()) + ACCESS_TOKEN_EXPIRE_SECONDS}
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(segment: bytes) -> bytes:
+    # Unpadded base64url only; the stdlib decoder would otherwise skip stray characters and padding
+    if not _B64URL_SEGMENT.fullmatch(segment):
+        raise ValueError("invalid base64url segment")
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+def decode_access_token(token: str) -> dict:
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return username
-    except jwt.ExpiredSignatureError:
+        header, payload, signature = token.encode().split(b".")
+        if header != _JWT_HEADER:
+            raise ValueError("unexpected header")
+        mac = _jwt_hmac.copy()
+        mac.update(header + b"." + payload)
+        # Compare encoded forms so only the canonical encoding of the signature is accepted
+        if not hmac.compare_digest(_b64url_encode(mac.digest()), signature):
+            raise ValueError("bad signature")
+        claims = orjson.loads(_b64url_decode(payload))
+        if not isinstance(claims, dict) or not isinstance(claims.get("exp"), (int, float)):
+            raise ValueError("malformed claims")
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if claims["exp"] <= time.time():
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
+    return claims
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _jwt_cache.get(key)
+    if cached is not None:
+        username, exp = cached
+        if exp > time.time():
+            return username
+        _jwt_cache.pop(key, None)
+    payload = decode_access_token(token)
+    username: str = payload.get("sub")
+    if username is None:
         raise HTTPException(status_code=401, detail="Invalid token")
+    # Only successful verifications are cached
+    _jwt_cache[key] = (username, payload["exp"])
+    return username
 
 # Auth endpoints
 @api_router.post("/auth/register", response_model=Token)
-async def register(user: UserRegister):
+@limiter.limit("5/minute")
+async def register(request: Request, user: UserRegister):
     existing_user = await db.users.find_one({"username": user.username})
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     user_doc = {
         "username": user.username,
         "password": hashed_password,
         "created_at": datetime.utcnow()
     }
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration of the same name
+        raise HTTPException(status_code=400, detail="Username already exists")
     
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer", "username": user.username}
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(user: UserLogin):
+@limiter.limit("5/minute")
+async def login(request: Request, user: UserLogin):
     db_user = await db.users.find_one({"username": user.username})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not db_user or not await verify_password(user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade legacy hashes (e.g. bcrypt) now that we have the plaintext
+    if pwd_context.needs_update(db_user["password"]):
+        await db.users.update_one(
+            {"_id": db_user["_id"]},
+            {"$set": {"password": await get_password_hash(user.password)}}
+        )
+    
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer", "username": user.username}
 
-# Seedlings Received endpoints
-@api_router.post("/seedlings-received")
-async def create_seedling_received(seedling: SeedlingReceived, username: str = Depends(get_current_user)):
-    seedling_dict = seedling.dict()
-    seedling_dict["user_id"] = username
-    result = await db.seedlings_received.insert_one(seedling_dict)
-    seedling_dict["_id"] = str(result.inserted_id)
-    return seedling_dict
-
-@api_router.get("/seedlings-received")
-async def get_seedlings_received(username: str = Depends(get_current_user)):
-    seedlings = await db.seedlings_received.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for s in seedlings:
-        s["_id"] = str(s["_id"])
-    return seedlings
-
-@api_router.delete("/seedlings-received/{id}")
-async def delete_seedling_received(id: str, username: str = Depends(get_current_user)):
-    result = await db.seedlings_received.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
-
-# Delivery Notes endpoints
-@api_router.post("/delivery-notes")
-async def create_delivery_note(note: DeliveryNote, username: str = Depends(get_current_user)):
-    note_dict = note.dict()
-    note_dict["user_id"] = username
-    result = await db.delivery_notes.insert_one(note_dict)
-    note_dict["_id"] = str(result.inserted_id)
-    return note_dict
-
-@api_router.get("/delivery-notes")
-async def get_delivery_notes(username: str = Depends(get_current_user)):
-    notes = await db.delivery_notes.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for n in notes:
-        n["_id"] = str(n["_id"])
-    return notes
-
-@api_router.delete("/delivery-notes/{id}")
-async def delete_delivery_note(id: str, username: str = Depends(get_current_user)):
-    result = await db.delivery_notes.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
-
-# Dead Seedlings endpoints
-@api_router.post("/dead-seedlings")
-async def create_dead_seedling(seedling: DeadSeedling, username: str = Depends(get_current_user)):
-    seedling_dict = seedling.dict()
-    seedling_dict["user_id"] = username
-    result = await db.dead_seedlings.insert_one(seedling_dict)
-    seedling_dict["_id"] = str(result.inserted_id)
-    return seedling_dict
-
-@api_router.get("/dead-seedlings")
-async def get_dead_seedlings(username: str = Depends(get_current_user)):
-    seedlings = await db.dead_seedlings.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for s in seedlings:
-        s["_id"] = str(s["_id"])
-    return seedlings
-
-@api_router.delete("/dead-seedlings/{id}")
-async def delete_dead_seedling(id: str, username: str = Depends(get_current_user)):
-    result = await db.dead_seedlings.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
-
-# Discarded Seedlings endpoints
-@api_router.post("/discarded-seedlings")
-async def create_discarded_seedling(seedling: DiscardedSeedling, username: str = Depends(get_current_user)):
-    seedling_dict = seedling.dict()
-    seedling_dict["user_id"] = username
-    result = await db.discarded_seedlings.insert_one(seedling_dict)
-    seedling_dict["_id"] = str(result.inserted_id)
-    return seedling_dict
-
-@api_router.get("/discarded-seedlings")
-async def get_discarded_seedlings(username: str = Depends(get_current_user)):
-    seedlings = await db.discarded_seedlings.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for s in seedlings:
-        s["_id"] = str(s["_id"])
-    return seedlings
-
-@api_router.delete("/discarded-seedlings/{id}")
-async def delete_discarded_seedling(id: str, username: str = Depends(get_current_user)):
-    result = await db.discarded_seedlings.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
-
-# Nursery Produced endpoints
-@api_router.post("/nursery-produced")
-async def create_nursery_produced(seedling: NurseryProduced, username: str = Depends(get_current_user)):
-    seedling_dict = seedling.dict()
-    seedling_dict["user_id"] = username
-    result = await db.nursery_produced.insert_one(seedling_dict)
-    seedling_dict["_id"] = str(result.inserted_id)
-    return seedling_dict
-
-@api_router.get("/nursery-produced")
-async def get_nursery_produced(username: str = Depends(get_current_user)):
-    seedlings = await db.nursery_produced.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for s in seedlings:
-        s["_id"] = str(s["_id"])
-    return seedlings
-
-@api_router.delete("/nursery-produced/{id}")
-async def delete_nursery_produced(id: str, username: str = Depends(get_current_user)):
-    result = await db.nursery_produced.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
-
-# Distributed Seedlings endpoints
-@api_router.post("/distributed-seedlings")
-async def create_distributed_seedling(seedling: DistributedSeedling, username: str = Depends(get_current_user)):
-    seedling_dict = seedling.dict()
-    seedling_dict["user_id"] = username
-    result = await db.distributed_seedlings.insert_one(seedling_dict)
-    seedling_dict["_id"] = str(result.inserted_id)
-    return seedling_dict
-
-@api_router.get("/distributed-seedlings")
-async def get_distributed_seedlings(username: str = Depends(get_current_user)):
-    seedlings = await db.distributed_seedlings.find({"user_id": username}).sort("created_at", -1).to_list(1000)
-    for s in seedlings:
-        s["_id"] = str(s["_id"])
-    return seedlings
-
-@api_router.delete("/distributed-seedlings/{id}")
-async def delete_distributed_seedling(id: str, username: str = Depends(get_current_user)):
-    result = await db.distributed_seedlings.delete_one({"_id": ObjectId(id), "user_id": username})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return {"message": "Deleted successfully"}
+# CRUD endpoints
+def valid_oid(id: str) -> ObjectId:
+    # Reject malformed ids before they cost a database round-trip
+    try:
+        return ObjectId(id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid id")
+
+# Counted writes are bracketed on the user's counters document: writes_started is bumped before
+# the record is written and writes_finished together with the total afterwards. A gap between
+# the two that outlives STALE_WRITE_SECONDS means a write died half-way and the totals need a
+# rebuild; a fresh gap is just a write in flight.
+STALE_WRITE_SECONDS = 300
+
+async def begin_counted_write(username: str):
+    await db.user_counters.update_one(
+        {"_id": username},
+        {
+            "$inc": {"writes_started": 1},
+            "$set": {"last_write_at": time.time()},
+            "$setOnInsert": {"writes_finished": 0},
+        },
+        upsert=True
+    )
+
+async def finish_counted_write(username: str, counter: str, amount: int):
+    try:
+        await db.user_counters.update_one(
+            {"_id": username},
+            {"$inc": {counter: amount, "writes_finished": 1}}
+        )
+    except PyMongoError:
+        # The record itself is already written, so don't fail the request over the counter;
+        # the open write marks the counters for a rebuild
+        logger.exception("Failed to update %s for %s; counters will be rebuilt", counter, username)
+
+MAX_BULK_ITEMS = 500
+
+def register_crud(router: APIRouter, path: str, collection, Model, counter: Optional[str] = None):
+    async def create_item(item: Model, username: str = Depends(get_current_user)):
+        item_dict = item.model_dump(exclude={"user_id"}) | {"user_id": username}
+        if counter:
+            await begin_counted_write(username)
+        result = await collection.insert_one(item_dict)
+        if counter:
+            await finish_counted_write(username, counter, item_dict["quantity"])
+        item_dict["_id"] = str(result.inserted_id)
+        return item_dict
+
+    async def create_items(
+        items: Annotated[List[Model], Body(min_length=1, max_length=MAX_BULK_ITEMS)],
+        username: str = Depends(get_current_user),
+    ):
+        # One insert_many round-trip for the whole batch
+        docs = [item.model_dump(exclude={"user_id"}) | {"user_id": username} for item in items]
+        if counter:
+            await begin_counted_write(username)
+        try:
+            await collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: everything not listed in writeErrors was inserted
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            inserted = [d for i, d in enumerate(docs) if i not in failed]
+            if counter:
+                await finish_counted_write(username, counter, sum(d["quantity"] for d in inserted))
+            raise HTTPException(status_code=500, detail={
+                "message": f"Inserted {len(inserted)} of {len(docs)} items",
+                "inserted_ids": [str(d["_id"]) for d in inserted]
+            })
+        if counter:
+            await finish_counted_write(username, counter, sum(d["quantity"] for d in docs))
+        return {"inserted_ids": [str(d["_id"]) for d in docs]}
+
+    async def list_items(
+        # Defaults to the old 1000-row page; the app screens don't send limit/before yet
+        limit: int = Query(1000, ge=1, le=1000),
+        before: Optional[str] = None,
+        username: str = Depends(get_current_user),
+    ):
+        # Keyset pagination on _id: pass the last _id of a page as `before` to get the next one
+        query = {"user_id": username}
+        if before:
+            try:
+                query["_id"] = {"$lt": ObjectId(before)}
+            except InvalidId:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        # Clients key rows by _id, so let Mongo stringify it instead of looping in Python
+        items = await collection.aggregate([
+            {"$match": query},
+            {"$sort": {"_id": -1}},
+            {"$limit": limit},
+            {"$addFields": {"_id": {"$toString": "$_id"}}}
+        ]).to_list(limit)
+        # Returned directly so the rows skip jsonable_encoder; orjson handles datetimes natively
+        return ORJSONResponse(items)
+
+    # Auth is declared first so unauthenticated callers are rejected before the id is validated
+    async def delete_item(username: str = Depends(get_current_user), oid: ObjectId = Depends(valid_oid)):
+        if counter:
+            await begin_counted_write(username)
+        deleted = await collection.find_one_and_delete(
+            {"_id": oid, "user_id": username},
+            projection={"quantity": 1}
+        )
+        if counter:
+            await finish_counted_write(username, counter, -deleted.get("quantity", 0) if deleted else 0)
+        if deleted is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return {"message": "Deleted successfully"}
+
+    router.post(path, name=f"create_{collection.name}")(create_item)
+    router.post(f"{path}/bulk", name=f"create_{collection.name}_bulk")(create_items)
+    router.get(path, name=f"get_{collection.name}")(list_items)
+    router.delete(f"{path}/{{id}}", name=f"delete_{collection.name}")(delete_item)
+
+register_crud(api_router, "/seedlings-received", db.seedlings_received, SeedlingReceived, "total_received")
+register_crud(api_router, "/delivery-notes", db.delivery_notes, DeliveryNote)
+register_crud(api_router, "/dead-seedlings", db.dead_seedlings, DeadSeedling, "total_dead")
+register_crud(api_router, "/discarded-seedlings", db.discarded_seedlings, DiscardedSeedling, "total_discarded")
+register_crud(api_router, "/nursery-produced", db.nursery_produced, NurseryProduced, "total_produced")
+register_crud(api_router, "/distributed-seedlings", db.distributed_seedlings, DistributedSeedling, "total_distributed")
 
 # Dashboard statistics
+COUNTER_COLLECTIONS = {
+    "total_received": "seedlings_received",
+    "total_dead": "dead_seedlings",
+    "total_discarded": "discarded_seedlings",
+    "total_produced": "nursery_produced",
+    "total_distributed": "distributed_seedlings",
+}
+
+def counters_stale(counters: dict) -> bool:
+    open_writes = counters.get("writes_started", 0) != counters.get("writes_finished", 0)
+    return open_writes and counters.get("last_write_at", 0) <= time.time() - STALE_WRITE_SECONDS
+
+async def rebuild_counters(username: Optional[str] = None) -> bool:
+    """Recompute user_counters from the collections, for one user or for everyone.
+
+    A user's totals are only replaced if none of their counted writes started or finished
+    while the collections were being summed, so concurrent $inc updates are never
+    overwritten. Returns False if any user had to be skipped; it is safe to retry.
+    """
+    now = time.time()
+    snapshot = {
+        doc["_id"]: doc
+        async for doc in db.user_counters.find({"_id": username} if username else {})
+    }
+    match = {"user_id": username} if username else {}
+    results = await asyncio.gather(*(
+        db[name].aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$user_id", "t": {"$sum": "$quantity"}}}
+        ]).to_list(None)
+        for name in COUNTER_COLLECTIONS.values()
+    ))
+    totals = {user: {} for user in snapshot}
+    if username:
+        totals.setdefault(username, {})
+    for counter, rows in zip(COUNTER_COLLECTIONS, results):
+        for row in rows:
+            totals.setdefault(row["_id"], {})[counter] = row["t"]
+
+    skipped = 0
+    ops = []
+    for user, user_totals in totals.items():
+        update = {counter: user_totals.get(counter, 0) for counter in COUNTER_COLLECTIONS}
+        doc = snapshot.get(user)
+        if doc is None or "writes_started" not in doc:
+            # No counted write has touched this user yet; the upsert fails if one does now
+            query = {"_id": user, "writes_started": {"$exists": False}}
+            update |= {"writes_started": 0, "writes_finished": 0}
+        else:
+            started, finished = doc["writes_started"], doc.get("writes_finished", 0)
+            if started != finished and doc.get("last_write_at", 0) > now - STALE_WRITE_SECONDS:
+                skipped += 1  # a write is in flight
+                continue
+            query = {
+                "_id": user,
+                "writes_started": started,
+                "writes_finished": doc["writes_finished"] if "writes_finished" in doc else {"$exists": False},
+            }
+            update |= {"writes_finished": started}
+        ops.append(UpdateOne(query, {"$set": update}, upsert=doc is None))
+    if ops:
+        try:
+            result = (await db.user_counters.bulk_write(ops, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+        skipped += len(ops) - result["nMatched"] - result["nUpserted"]
+    return skipped == 0
+
+@api_router.post("/dashboard/recount")
+async def recount_dashboard_stats(username: str = Depends(get_current_user)):
+    if not await rebuild_counters(username):
+        raise HTTPException(status_code=409, detail="Records are being updated, please try again")
+    return {"message": "Counters rebuilt"}
+
 @api_router.get("/dashboard/stats", response_model=DashboardStats)
 async def get_dashboard_stats(username: str = Depends(get_current_user)):
-    # Get totals
-    received = await db.seedlings_received.find({"user_id": username}).to_list(1000)
-    dead = await db.dead_seedlings.find({"user_id": username}).to_list(1000)
-    discarded = await db.discarded_seedlings.find({"user_id": username}).to_list(1000)
-    produced = await db.nursery_produced.find({"user_id": username}).to_list(1000)
-    distributed = await db.distributed_seedlings.find({"user_id": username}).to_list(1000)
-    
-    total_received = sum(s.get("quantity", 0) for s in received)
-    total_dead = sum(s.get("quantity", 0) for s in dead)
-    total_discarded = sum(s.get("quantity", 0) for s in discarded)
-    total_produced = sum(s.get("quantity", 0) for s in produced)
-    total_distributed = sum(s.get("quantity", 0) for s in distributed)
+    counters = await db.user_counters.find_one({"_id": username}) or {}
+    if counters_stale(counters):
+        await rebuild_counters(username)
+        counters = await db.user_counters.find_one({"_id": username}) or {}
+    total_received = counters.get("total_received", 0)
+    total_dead = counters.get("total_dead", 0)
+    total_discarded = counters.get("total_discarded", 0)
+    total_produced = counters.get("total_produced", 0)
+    total_distributed = counters.get("total_distributed", 0)
     
     # Calculate total in nursery and survival rate
     total_in_nursery = total_received + total_produced - total_dead - total_discarded - total_distributed
@@ -331,102 +504,39 @@ async def get_dashboard_stats(username: str = Depends(get_current_user)):
     }
 
 # Export to CSV
+CSV_SECTIONS = [
+    ("SEEDLINGS RECEIVED", "seedlings_received", ["date", "type", "supplier", "price", "lot_number", "quantity"]),
+    ("DELIVERY NOTES", "delivery_notes", ["date", "type", "expected_quantity", "actual_quantity"]),
+    ("DEAD SEEDLINGS", "dead_seedlings", ["date", "type", "quantity"]),
+    ("DISCARDED SEEDLINGS", "discarded_seedlings", ["date", "type", "quantity"]),
+    ("NURSERY PRODUCED", "nursery_produced", ["date", "type", "quantity", "parent_plant", "propagation_method"]),
+    ("DISTRIBUTED SEEDLINGS", "distributed_seedlings", ["date", "type", "quantity", "destination", "location"]),
+]
+
+async def stream_csv(username: str):
+    # Reuse one small buffer so only a single row is held in memory at a time
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def render(row):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        return buf.getvalue()
+
+    for index, (title, collection, fieldnames) in enumerate(CSV_SECTIONS):
+        yield f"\n=== {title} ===\n" if index == 0 else f"\n\n=== {title} ===\n"
+        header_written = False
+        async for item in db[collection].find({"user_id": username}):
+            if not header_written:
+                yield render(fieldnames)
+                header_written = True
+            yield render([item.get(field) for field in fieldnames])
+
 @api_router.get("/export/csv")
 async def export_to_csv(username: str = Depends(get_current_user)):
-    # Get all data
-    received = await db.seedlings_received.find({"user_id": username}).to_list(1000)
-    delivery = await db.delivery_notes.find({"user_id": username}).to_list(1000)
-    dead = await db.dead_seedlings.find({"user_id": username}).to_list(1000)
-    discarded = await db.discarded_seedlings.find({"user_id": username}).to_list(1000)
-    produced = await db.nursery_produced.find({"user_id": username}).to_list(1000)
-    distributed = await db.distributed_seedlings.find({"user_id": username}).to_list(1000)
-    
-    # Create CSV in memory
-    output = io.StringIO()
-    
-    # Seedlings Received
-    output.write("\n=== SEEDLINGS RECEIVED ===\n")
-    if received:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "supplier", "price", "lot_number", "quantity"])
-        writer.writeheader()
-        for item in received:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "supplier": item.get("supplier"),
-                "price": item.get("price"),
-                "lot_number": item.get("lot_number"),
-                "quantity": item.get("quantity")
-            })
-    
-    # Delivery Notes
-    output.write("\n\n=== DELIVERY NOTES ===\n")
-    if delivery:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "expected_quantity", "actual_quantity"])
-        writer.writeheader()
-        for item in delivery:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "expected_quantity": item.get("expected_quantity"),
-                "actual_quantity": item.get("actual_quantity")
-            })
-    
-    # Dead Seedlings
-    output.write("\n\n=== DEAD SEEDLINGS ===\n")
-    if dead:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "quantity"])
-        writer.writeheader()
-        for item in dead:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "quantity": item.get("quantity")
-            })
-    
-    # Discarded Seedlings
-    output.write("\n\n=== DISCARDED SEEDLINGS ===\n")
-    if discarded:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "quantity"])
-        writer.writeheader()
-        for item in discarded:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "quantity": item.get("quantity")
-            })
-    
-    # Nursery Produced
-    output.write("\n\n=== NURSERY PRODUCED ===\n")
-    if produced:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "quantity", "parent_plant", "propagation_method"])
-        writer.writeheader()
-        for item in produced:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "quantity": item.get("quantity"),
-                "parent_plant": item.get("parent_plant"),
-                "propagation_method": item.get("propagation_method")
-            })
-    
-    # Distributed Seedlings
-    output.write("\n\n=== DISTRIBUTED SEEDLINGS ===\n")
-    if distributed:
-        writer = csv.DictWriter(output, fieldnames=["date", "type", "quantity", "destination", "location"])
-        writer.writeheader()
-        for item in distributed:
-            writer.writerow({
-                "date": item.get("date"),
-                "type": item.get("type"),
-                "quantity": item.get("quantity"),
-                "destination": item.get("destination"),
-                "location": item.get("location")
-            })
-    
-    output.seek(0)
     return StreamingResponse(
-        iter([output.getvalue()]),
+        stream_csv(username),
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename=nursery_data_{datetime.now().strftime('%Y%m%d')}.csv"}
     )
@@ -437,17 +547,47 @@ app.include_router(api_router)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=["*"],
+    allow_origins=[o.strip() for o in os.environ.get('CORS_ORIGINS', '*').split(',') if o.strip()],
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let browsers cache preflight responses for a day
+    max_age=86400,
 )
 
+# List responses and CSV exports are highly repetitive and compress well
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    for name in ["seedlings_received", "delivery_notes", "dead_seedlings",
+                 "discarded_seedlings", "nursery_produced", "distributed_seedlings"]:
+        # Serves the paginated list queries (newest _id first) and the dashboard $match
+        await db[name].create_index([("user_id", 1), ("_id", -1)])
+    try:
+        await db.users.create_index("username", unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        # Databases created before this index may hold duplicate usernames; boot without it
+        logger.error(
+            "Duplicate usernames in 'users'; unique index not created. Find them with "
+            "db.users.aggregate([{$group: {_id: '$username', n: {$sum: 1}}}, {$match: {n: {$gt: 1}}}]), "
+            "remove or rename the extra accounts, then restart."
+        )
+
+@app.on_event("startup")
+async def backfill_counters():
+    # One-off seed for databases that predate user_counters; afterwards writes keep it current
+    if await db.user_counters.find_one() is None:
+        await rebuild_counters()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    _pw_executor.shutdown(wait=False)
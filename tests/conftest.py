@@ -0,0 +1,14 @@
+import os
+import sys
+from pathlib import Path
+
+import motor.motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+
+# server.py reads these at import time
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# Run the app against an in-memory MongoDB; must happen before server is imported
+motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+import server
+
+
+def make_request(ip):
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/api/auth/login",
+        "headers": [],
+        "client": (ip, 12345),
+        "app": server.app,
+    })
+
+
+@pytest.fixture
+def known_user(monkeypatch):
+    hashed = server.pwd_context.hash("right-password")
+
+    async def find_one(self, query, *args, **kwargs):
+        return {"_id": 1, "username": query["username"], "password": hashed}
+
+    monkeypatch.setattr(type(server.db.users), "find_one", find_one)
+
+
+async def attempt(ip, password):
+    try:
+        await server.login(make_request(ip), server.UserLogin(username="alice", password=password))
+        return 200
+    except HTTPException as e:
+        # Covers slowapi's RateLimitExceeded, which the app's handler turns into a 429
+        return e.status_code
+
+
+async def attempt_many(ip, password, n):
+    return await asyncio.gather(*(attempt(ip, password) for _ in range(n)))
+
+
+def test_concurrent_bad_logins_are_capped(known_user):
+    statuses = asyncio.run(attempt_many("203.0.113.10", "wrong", 40))
+    assert statuses.count(401) == 5
+    assert statuses.count(429) == 35
+
+
+def test_limit_is_per_client_ip(known_user):
+    asyncio.run(attempt_many("203.0.113.20", "wrong", 6))
+    assert asyncio.run(attempt("203.0.113.21", "wrong")) == 401
+
+
+def test_correct_password_still_logs_in(known_user):
+    assert asyncio.run(attempt("203.0.113.30", "right-password")) == 200
+
+
+def forwarded_request(peer, forwarded_for):
+    return Request({
+        "type": "http",
+        "headers": [(b"x-forwarded-for", forwarded_for.encode())],
+        "client": (peer, 12345),
+    })
+
+
+def test_client_ip_ignores_forwarded_for_from_untrusted_peer(monkeypatch):
+    monkeypatch.setattr(server, "FORWARDED_ALLOW_IPS", {"10.0.0.1"})
+    assert server.client_ip(forwarded_request("198.51.100.7", "1.2.3.4")) == "198.51.100.7"
+
+
+def test_client_ip_skips_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(server, "FORWARDED_ALLOW_IPS", {"10.0.0.1", "10.0.0.2"})
+    request = forwarded_request("10.0.0.1", "6.6.6.6, 198.51.100.7, 10.0.0.2")
+    assert server.client_ip(request) == "198.51.100.7"
+
+
+def test_client_ip_wildcard_takes_nearest_hop(monkeypatch):
+    monkeypatch.setattr(server, "FORWARDED_ALLOW_IPS", {"*"})
+    assert server.client_ip(forwarded_request("10.0.0.1", "6.6.6.6, 198.51.100.7")) == "198.51.100.7"
@@ -0,0 +1,137 @@
+import asyncio
+import base64
+import hashlib
+import json
+import time
+
+import jwt
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def pyjwt_token(claims, key=server.SECRET_KEY, algorithm="HS256", headers=None):
+    return jwt.encode(claims, key, algorithm=algorithm, headers=headers)
+
+
+def future_exp():
+    return int(time.time()) + 3600
+
+
+def assert_rejected(token, detail="Invalid token"):
+    with pytest.raises(HTTPException) as exc:
+        server.decode_access_token(token)
+    assert exc.value.status_code == 401
+    assert exc.value.detail == detail
+
+
+def test_accepts_token_minted_by_create_access_token():
+    token = server.create_access_token(data={"sub": "alice"})
+    claims = server.decode_access_token(token)
+    assert claims["sub"] == "alice"
+    assert claims["exp"] > time.time()
+
+
+def test_accepts_token_minted_by_pyjwt():
+    exp = future_exp()
+    claims = server.decode_access_token(pyjwt_token({"sub": "bob", "exp": exp}))
+    assert claims == {"sub": "bob", "exp": exp}
+
+
+def test_rejects_tampered_payload():
+    header, _, signature = pyjwt_token({"sub": "bob", "exp": future_exp()}).split(".")
+    forged = b64url(json.dumps({"sub": "admin", "exp": future_exp()}).encode())
+    assert_rejected(f"{header}.{forged}.{signature}")
+
+
+def test_rejects_wrong_signature():
+    assert_rejected(pyjwt_token({"sub": "bob", "exp": future_exp()}, key="another_key"))
+    header, payload, _ = pyjwt_token({"sub": "bob", "exp": future_exp()}).split(".")
+    assert_rejected(f"{header}.{payload}.{b64url(b'0' * 32)}")
+
+
+def test_rejects_padded_or_non_canonical_signature():
+    token = pyjwt_token({"sub": "bob", "exp": future_exp()})
+    assert_rejected(token + "=")
+    assert_rejected(token + "==")
+    header, payload, signature = token.split(".")
+    # Inserting characters the lenient stdlib decoder would skip
+    assert_rejected(f"{header}.{payload}.{signature[:4]}!{signature[4:]}")
+
+
+def test_rejects_alg_none():
+    header = b64url(b'{"alg":"none","typ":"JWT"}')
+    payload = b64url(json.dumps({"sub": "bob", "exp": future_exp()}).encode())
+    assert_rejected(f"{header}.{payload}.")
+
+
+def test_rejects_other_headers():
+    assert_rejected(pyjwt_token({"sub": "bob", "exp": future_exp()}, algorithm="HS512"))
+    assert_rejected(pyjwt_token({"sub": "bob", "exp": future_exp()}, headers={"kid": "1"}))
+
+
+def test_rejects_expired_token():
+    token = pyjwt_token({"sub": "bob", "exp": int(time.time()) - 10})
+    assert_rejected(token, detail="Token expired")
+
+
+def test_rejects_missing_exp():
+    assert_rejected(pyjwt_token({"sub": "bob"}))
+
+
+@pytest.mark.parametrize("token", ["", "abc", "a.b", "a.b.c.d", "x.y.z", "é.é.é"])
+def test_rejects_malformed_tokens(token):
+    assert_rejected(token)
+
+
+def test_get_current_user_requires_sub():
+    token = pyjwt_token({"exp": future_exp()})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.get_current_user(credentials))
+    assert exc.value.status_code == 401
+
+
+def cache_key(token):
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def test_get_current_user_caches_successful_verification():
+    token = server.create_access_token(data={"sub": "carol"})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    server._jwt_cache.pop(cache_key(token), None)
+    assert asyncio.run(server.get_current_user(credentials)) == "carol"
+    username, exp = server._jwt_cache[cache_key(token)]
+    assert username == "carol"
+    assert exp > time.time()
+
+
+def test_get_current_user_serves_cache_hits_without_decoding(monkeypatch):
+    token = server.create_access_token(data={"sub": "dave"})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    asyncio.run(server.get_current_user(credentials))
+
+    def fail(token):
+        raise AssertionError("cache hit should not decode")
+
+    monkeypatch.setattr(server, "decode_access_token", fail)
+    assert asyncio.run(server.get_current_user(credentials)) == "dave"
+
+
+def test_get_current_user_does_not_cache_failures():
+    bad_tokens = [
+        pyjwt_token({"sub": "bob", "exp": future_exp()}, key="another_key"),
+        pyjwt_token({"sub": "bob", "exp": int(time.time()) - 10}),
+        pyjwt_token({"exp": future_exp()}),
+    ]
+    for token in bad_tokens:
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        with pytest.raises(HTTPException):
+            asyncio.run(server.get_current_user(credentials))
+        assert cache_key(token) not in server._jwt_cache
@@ -0,0 +1,221 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import BulkWriteError
+
+import server
+
+client = TestClient(server.app)
+
+COLLECTIONS = ["seedlings_received", "delivery_notes", "dead_seedlings", "discarded_seedlings",
+               "nursery_produced", "distributed_seedlings", "user_counters"]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    for name in COLLECTIONS:
+        run(server.db[name].delete_many({}))
+
+
+def auth_headers(username="alice"):
+    return {"Authorization": f"Bearer {server.create_access_token(data={'sub': username})}"}
+
+
+def dead(quantity):
+    return {"date": "2025-01-01", "type": "Oak", "quantity": quantity, "user_id": "ignored"}
+
+
+def received(quantity):
+    return {"date": "2025-01-01", "type": "Oak", "supplier": "S", "price": 1.5,
+            "lot_number": "L1", "quantity": quantity, "user_id": "ignored"}
+
+
+def counters(username="alice"):
+    return run(server.db.user_counters.find_one({"_id": username}))
+
+
+def stats(username="alice"):
+    response = client.get("/api/dashboard/stats", headers=auth_headers(username))
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_first_write_creates_counters():
+    response = client.post("/api/dead-seedlings", json=dead(4), headers=auth_headers())
+    assert response.status_code == 200
+    doc = counters()
+    assert doc["total_dead"] == 4
+    assert doc["writes_started"] == doc["writes_finished"] == 1
+
+
+def test_create_bulk_and_delete_update_totals():
+    headers = auth_headers()
+    created = client.post("/api/seedlings-received", json=received(10), headers=headers).json()
+    response = client.post("/api/seedlings-received/bulk", json=[received(3), received(5)], headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()["inserted_ids"]) == 2
+    assert stats()["total_received"] == 18
+
+    assert client.delete(f"/api/seedlings-received/{created['_id']}", headers=headers).status_code == 200
+    assert stats()["total_received"] == 8
+    doc = counters()
+    assert doc["writes_started"] == doc["writes_finished"] == 3
+
+
+def test_delete_of_missing_item_closes_the_write():
+    response = client.delete("/api/dead-seedlings/0123456789abcdef01234567", headers=auth_headers())
+    assert response.status_code == 404
+    doc = counters()
+    assert doc["writes_started"] == doc["writes_finished"] == 1
+    assert doc["total_dead"] == 0
+
+
+def test_uncounted_collection_leaves_counters_alone():
+    note = {"date": "2025-01-01", "type": "Oak", "expected_quantity": 5, "actual_quantity": 4, "user_id": "x"}
+    assert client.post("/api/delivery-notes", json=note, headers=auth_headers()).status_code == 200
+    assert counters() is None
+
+
+def test_dashboard_stats_read_counters():
+    headers = auth_headers()
+    client.post("/api/seedlings-received", json=received(10), headers=headers)
+    client.post("/api/dead-seedlings", json=dead(2), headers=headers)
+    assert stats() == {
+        "total_received": 10,
+        "total_dead": 2,
+        "total_discarded": 0,
+        "total_produced": 0,
+        "total_distributed": 0,
+        "survival_rate": 80.0,
+        "total_in_nursery": 8,
+    }
+
+
+def seed_records():
+    run(server.db.seedlings_received.insert_many([
+        {"user_id": "alice", "quantity": 5},
+        {"user_id": "alice", "quantity": 7},
+        {"user_id": "bob", "quantity": 2},
+    ]))
+    run(server.db.dead_seedlings.insert_one({"user_id": "alice", "quantity": 1}))
+
+
+def test_rebuild_all_users():
+    seed_records()
+    # carol has a counters document but no records left
+    run(server.db.user_counters.insert_one({"_id": "carol", "total_dead": 9}))
+    assert run(server.rebuild_counters()) is True
+    assert counters("alice")["total_received"] == 12
+    assert counters("alice")["total_dead"] == 1
+    assert counters("bob")["total_received"] == 2
+    assert counters("carol")["total_dead"] == 0
+
+
+def test_rebuild_single_user_only_touches_that_user():
+    seed_records()
+    run(server.db.user_counters.insert_many([
+        {"_id": "alice", "total_received": 999, "writes_started": 2, "writes_finished": 2},
+        {"_id": "bob", "total_received": 999, "writes_started": 1, "writes_finished": 1},
+    ]))
+    assert run(server.rebuild_counters("alice")) is True
+    assert counters("alice")["total_received"] == 12
+    assert counters("alice")["writes_started"] == counters("alice")["writes_finished"] == 2
+    assert counters("bob")["total_received"] == 999
+
+
+def test_rebuild_skips_user_with_write_in_flight():
+    seed_records()
+    run(server.db.user_counters.insert_one({
+        "_id": "alice", "total_received": 999,
+        "writes_started": 3, "writes_finished": 2, "last_write_at": time.time(),
+    }))
+    assert run(server.rebuild_counters("alice")) is False
+    assert counters("alice")["total_received"] == 999
+    response = client.post("/api/dashboard/recount", headers=auth_headers())
+    assert response.status_code == 409
+
+
+def test_rebuild_does_not_overwrite_concurrent_write(monkeypatch):
+    seed_records()
+    run(server.rebuild_counters("alice"))
+    collection_type = type(server.db.user_counters)
+    original = collection_type.bulk_write
+
+    async def bulk_write_after_concurrent_write(self, ops, **kwargs):
+        # A create lands between the aggregation and the rebuild's write
+        await server.db.seedlings_received.insert_one({"user_id": "alice", "quantity": 100})
+        await server.begin_counted_write("alice")
+        await server.finish_counted_write("alice", "total_received", 100)
+        return await original(self, ops, **kwargs)
+
+    monkeypatch.setattr(collection_type, "bulk_write", bulk_write_after_concurrent_write)
+    assert run(server.rebuild_counters("alice")) is False
+    assert counters("alice")["total_received"] == 112
+
+
+def test_recount_endpoint_rebuilds_current_user():
+    seed_records()
+    run(server.db.user_counters.insert_one({"_id": "alice", "total_received": 999}))
+    response = client.post("/api/dashboard/recount", headers=auth_headers())
+    assert response.status_code == 200
+    assert stats()["total_received"] == 12
+
+
+def test_failed_counter_update_is_rebuilt_once_stale(monkeypatch):
+    collection_type = type(server.db.user_counters)
+    original = collection_type.update_one
+
+    async def failing_finish(self, query, update, **kwargs):
+        if "writes_finished" in update.get("$inc", {}):
+            raise server.PyMongoError("pool timeout")
+        return await original(self, query, update, **kwargs)
+
+    monkeypatch.setattr(collection_type, "update_one", failing_finish)
+    response = client.post("/api/dead-seedlings", json=dead(6), headers=auth_headers())
+    assert response.status_code == 200
+    monkeypatch.setattr(collection_type, "update_one", original)
+
+    # Still looks like a write in flight, so the dashboard leaves it alone
+    assert stats()["total_dead"] == 0
+    run(server.db.user_counters.update_one(
+        {"_id": "alice"}, {"$set": {"last_write_at": time.time() - server.STALE_WRITE_SECONDS - 1}}
+    ))
+    assert stats()["total_dead"] == 6
+    doc = counters()
+    assert doc["writes_started"] == doc["writes_finished"]
+
+
+def test_partial_bulk_insert_counts_inserted_items(monkeypatch):
+    collection_type = type(server.db.dead_seedlings)
+    original = collection_type.insert_many
+
+    async def insert_all_but_second(self, docs, **kwargs):
+        kept = [d for i, d in enumerate(docs) if i != 1]
+        await original(self, kept, **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}],
+                              "nInserted": len(kept)})
+
+    monkeypatch.setattr(collection_type, "insert_many", insert_all_but_second)
+    response = client.post("/api/dead-seedlings/bulk", json=[dead(1), dead(10), dead(100)],
+                           headers=auth_headers())
+    assert response.status_code == 500
+    assert len(response.json()["detail"]["inserted_ids"]) == 2
+    doc = counters()
+    assert doc["total_dead"] == 101
+    assert doc["writes_started"] == doc["writes_finished"] == 1
+
+
+def test_backfill_only_runs_on_empty_counters():
+    seed_records()
+    run(server.backfill_counters())
+    assert counters("alice")["total_received"] == 12
+
+    run(server.db.seedlings_received.insert_one({"user_id": "alice", "quantity": 50}))
+    run(server.backfill_counters())
+    assert counters("alice")["total_received"] == 12
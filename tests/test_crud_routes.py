@@ -0,0 +1,19 @@
+from fastapi.testclient import TestClient
+
+import server
+
+client = TestClient(server.app)
+
+
+def auth_headers(username="alice"):
+    return {"Authorization": f"Bearer {server.create_access_token(data={'sub': username})}"}
+
+
+def test_delete_rejects_unauthenticated_before_validating_id():
+    assert client.delete("/api/dead-seedlings/notanid").status_code == 403
+
+
+def test_delete_rejects_malformed_id():
+    response = client.delete("/api/dead-seedlings/notanid", headers=auth_headers())
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid id"}